@@ -1,23 +1,47 @@
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import os
 import argparse
 import soundfile as sf
 
 from demucs.states import load_model
 from demucs import pretrained
-from demucs.apply import apply_model
+from demucs.apply import apply_model, BagOfModels
 import onnxruntime as ort
 from time import time
-import librosa
+import torchaudio
 import hashlib
-import sys
+import mmap
+import shutil
+import struct
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 
 __VERSION__ = '1.0.1'
 
 
+# Window tensors are only read, so all MDX models on a device share them
+@functools.lru_cache(maxsize=8)
+def get_hann_window(n_fft, device):
+    return torch.hann_window(window_length=n_fft, periodic=True).to(device)
+
+
+@functools.lru_cache(maxsize=8)
+def get_istft_envelope(n_fft, hop, dim_t, device):
+    # Overlap-added squared window over the centered output, torch.istft rebuilds and checks it on every call
+    window = get_hann_window(n_fft, device)
+    envelope = F.fold(
+        window.pow(2)[None, :, None].expand(1, n_fft, dim_t),
+        output_size=(1, n_fft + hop * (dim_t - 1)),
+        kernel_size=(1, n_fft),
+        stride=(1, hop),
+    )
+    return envelope.reshape(-1)[n_fft // 2:n_fft // 2 + hop * (dim_t - 1)]
+
+
 class Conv_TDF_net_trim_model(nn.Module):
     def __init__(self, device, target_name, L, n_fft, hop=1024):
 
@@ -29,30 +53,40 @@ class Conv_TDF_net_trim_model(nn.Module):
         self.hop = hop
         self.n_bins = self.n_fft // 2 + 1
         self.chunk_size = hop * (self.dim_t - 1)
-        self.window = torch.hann_window(window_length=self.n_fft, periodic=True).to(device)
+        self.window = get_hann_window(self.n_fft, device)
+        self.istft_envelope = get_istft_envelope(self.n_fft, self.hop, self.dim_t, device)
         self.target_name = target_name
 
-        out_c = self.dim_c * 4 if target_name == '*' else self.dim_c
-        self.freq_pad = torch.zeros([1, out_c, self.n_bins - self.dim_f, self.dim_t]).to(device)
-
         self.n = L // 2
+        self.mix_buffer = None
+
+    def get_input_shape(self, chunk_size):
+        # Largest batch of spectrograms demix_full sends to the ONNX model for given chunk size
+        batch_size = chunk_size // (self.chunk_size - self.n_fft) + 1
+        return batch_size, self.dim_c, self.dim_f, self.dim_t
+
+    def get_mix_buffer(self, size):
+        # Host buffer for the padded mix, reused between demix_full calls and only grown when needed
+        if self.mix_buffer is None or self.mix_buffer.shape[1] < size:
+            self.mix_buffer = np.empty((2, size), dtype=np.float32)
+        return self.mix_buffer[:, :size]
 
     def stft(self, x):
         x = x.reshape([-1, self.chunk_size])
         x = torch.stft(x, n_fft=self.n_fft, hop_length=self.hop, window=self.window, center=True, return_complex=True)
-        x = torch.view_as_real(x)
-        x = x.permute([0, 3, 1, 2])
-        x = x.reshape([-1, 2, 2, self.n_bins, self.dim_t]).reshape([-1, self.dim_c, self.n_bins, self.dim_t])
-        return x[:, :, :self.dim_f]
-
-    def istft(self, x, freq_pad=None):
-        freq_pad = self.freq_pad.repeat([x.shape[0], 1, 1, 1]) if freq_pad is None else freq_pad
-        x = torch.cat([x, freq_pad], -2)
-        x = x.reshape([-1, 2, 2, self.n_bins, self.dim_t]).reshape([-1, 2, self.n_bins, self.dim_t])
-        x = x.permute([0, 2, 3, 1])
-        x = x.contiguous()
-        x = torch.view_as_complex(x)
-        x = torch.istft(x, n_fft=self.n_fft, hop_length=self.hop, window=self.window, center=True)
+        # Only the kept bins are copied, real and imaginary parts land directly in the model layout
+        x = x[:, :self.dim_f]
+        x = torch.stack([x.real, x.imag], dim=1)
+        return x.reshape([-1, self.dim_c, self.dim_f, self.dim_t])
+
+    def istft(self, x):
+        x = x.reshape([-1, 2, self.dim_f, self.dim_t])
+        x = torch.complex(x[:, 0], x[:, 1])
+        # Same as torch.istft: inverse FFT of every frame, then overlap-add them as a transposed convolution.
+        # irfft zero-fills the frequency bins above dim_f
+        x = torch.fft.irfft(x, n=self.n_fft, dim=1) * self.window[:, None]
+        x = F.fold(x, output_size=(1, self.n_fft + self.chunk_size), kernel_size=(1, self.n_fft), stride=(1, self.hop))
+        x = x.reshape([x.shape[0], -1])[:, self.n_fft // 2:self.n_fft // 2 + self.chunk_size] / self.istft_envelope
         return x.reshape([-1, 2, self.chunk_size])
 
     def forward(self, x):
@@ -95,69 +129,249 @@ def get_models(name, device, load=True, vocals_model_type=0):
     return [model_vocals]
 
 
-def demix_base(mix, device, models, infer_session):
-    start_time = time()
-    sources = []
-    n_sample = mix.shape[1]
-    for model in models:
-        trim = model.n_fft // 2
-        gen_size = model.chunk_size - 2 * trim
-        pad = gen_size - n_sample % gen_size
-        mix_p = np.concatenate(
-            (
-                np.zeros((2, trim)),
-                mix,
-                np.zeros((2, pad)),
-                np.zeros((2, trim))
-            ), 1
-        )
-
-        mix_waves = []
-        i = 0
-        while i < n_sample + pad:
-            waves = np.array(mix_p[:, i:i + model.chunk_size])
-            mix_waves.append(waves)
-            i += gen_size
-        mix_waves = np.array(mix_waves)  # Convert the list to a single numpy.ndarray
-        mix_waves = torch.tensor(mix_waves, dtype=torch.float32).to(device)
-
-    with torch.no_grad():
+def get_infer_session(model_path, providers, device_id, low_memory=False, use_trt=False, stream=None, input_shape=None):
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    provider_options = [{"device_id": device_id}]
+    if low_memory:
+        # Session stays alive between files, so keep its memory close to what is actually requested
+        sess_options.enable_cpu_mem_arena = False
+        sess_options.enable_mem_pattern = False
+        if "CUDAExecutionProvider" in providers:
+            provider_options[0]["arena_extend_strategy"] = "kSameAsRequested"
+    if use_trt:
+        # Engines take minutes to build on first run, they are cached next to the models for later runs
+        providers = ["TensorrtExecutionProvider"] + providers
+        provider_options = [{
+            "device_id": device_id,
+            "trt_fp16_enable": True,
+            "trt_engine_cache_enable": True,
+            "trt_engine_cache_path": os.path.join(os.path.dirname(model_path), 'trt_cache'),
+            "trt_max_workspace_size": 4 * 1024 ** 3,
+        }] + provider_options
+        if input_shape is not None:
+            # Last batch of every file is smaller, one profile for all batch sizes avoids engine rebuilds
+            dims = 'x'.join(str(d) for d in input_shape[1:])
+            provider_options[0]["trt_profile_min_shapes"] = 'input:1x{}'.format(dims)
+            provider_options[0]["trt_profile_opt_shapes"] = 'input:{}x{}'.format(input_shape[0], dims)
+            provider_options[0]["trt_profile_max_shapes"] = 'input:{}x{}'.format(input_shape[0], dims)
+    if stream is not None:
+        # Run on a torch stream, so ONNX work is ordered after the bound tensors are produced on it
+        for options in provider_options:
+            options["user_compute_stream"] = str(stream.cuda_stream)
+    return ort.InferenceSession(
+        model_path,
+        sess_options=sess_options,
+        providers=providers,
+        provider_options=provider_options,
+    )
+
+
+def get_low_memory_run_options(device_id):
+    # Sessions stay alive between files. After a run their GPU arena gives back unused memory,
+    # so it's free for Demucs models instead of staying at the peak MDX size
+    run_options = ort.RunOptions()
+    run_options.add_run_config_entry('memory.enable_memory_arena_shrinkage', 'gpu:{}'.format(device_id))
+    return run_options
+
+
+def get_fp16_onnx_path(model_path):
+    # Converted once and stored next to the original model, inputs and outputs stay float32
+    fp16_path = os.path.splitext(model_path)[0] + '.fp16.onnx'
+    if not os.path.isfile(fp16_path):
+        import onnx
+        from onnxconverter_common import float16
+        print('Convert model to FP16: {}'.format(fp16_path))
+        onnx_model = float16.convert_float_to_float16(onnx.load(model_path), keep_io_types=True)
+        onnx.save(onnx_model, fp16_path)
+    return fp16_path
+
+
+# Demucs models kept on CPU between files by the low GPU memory version
+_MODEL_CACHE = {}
+
+
+def get_demucs_model(name):
+    # Checkpoint paths go through load_model, everything else is a pretrained model name
+    if name not in _MODEL_CACHE:
+        if name.endswith('.th'):
+            _MODEL_CACHE[name] = load_model(name)
+        else:
+            _MODEL_CACHE[name] = pretrained.get_model(name)
+    return _MODEL_CACHE[name]
+
+
+def compile_model(model, mode='reduce-overhead'):
+    # Compile sub-models in place: apply_model needs the original BagOfModels/HTDemucs types and attributes
+    sub_models = model.models if isinstance(model, BagOfModels) else [model]
+    for sub_model in sub_models:
+        sub_model.compile(mode=mode, fullgraph=False)
+
+
+def to_device(array, device):
+    # Upload from page-locked memory so the copy to GPU doesn't block the host
+    tensor = torch.from_numpy(array).float()
+    if torch.device(device).type == 'cuda':
+        tensor = tensor.pin_memory().to(device, non_blocking=True)
+    return tensor
+
+
+def apply_model_both_polarities(model, audio, shifts, overlap, batched=True):
+    # Average over the mix and its inverted polarity
+    if batched:
+        # Both processed in a single batch
+        out = apply_model(model, torch.cat([audio, -audio], dim=0), shifts=shifts, overlap=overlap)
+        return 0.5 * (out[0] - out[1])
+    # One after another, half of the batched peak GPU memory. First result waits on CPU
+    out = apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu()
+    out -= apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu()
+    return 0.5 * out
+
+
+def demix_base(mix_waves, model, infer_session, io_binding=None, run_options=None):
+    """
+        Runs a batch of (windows, 2, model.chunk_size) waves through the MDX model and
+        returns the generated part of every window without the trim margins, on the same device
+    """
+    trim = model.n_fft // 2
+    with torch.inference_mode():
         _ort = infer_session
-        stft_res = model.stft(mix_waves)
-        res = _ort.run(None, {'input': stft_res.cpu().numpy()})[0]
-        ten = torch.tensor(res).to(device)  # Move result tensor to device
+        if io_binding is None:
+            io_binding = _ort.io_binding()
+        stft_res = model.stft(mix_waves).contiguous()
+        # Bind torch buffers directly so ONNX Runtime reads and writes device memory without host copies
+        ten = torch.empty(stft_res.shape, dtype=torch.float32, device=stft_res.device)
+        device_type = stft_res.device.type
+        device_id = stft_res.device.index or 0
+        io_binding.bind_input(
+            'input',
+            device_type=device_type,
+            device_id=device_id,
+            element_type=np.float32,
+            shape=tuple(stft_res.shape),
+            buffer_ptr=stft_res.data_ptr(),
+        )
+        io_binding.bind_output(
+            _ort.get_outputs()[0].name,
+            device_type=device_type,
+            device_id=device_id,
+            element_type=np.float32,
+            shape=tuple(ten.shape),
+            buffer_ptr=ten.data_ptr(),
+        )
+        if device_type == 'cuda':
+            # Session running on the current stream is already ordered after the input.
+            # Otherwise wait only for that stream, a device-wide sync would stall other streams
+            stream = torch.cuda.current_stream(stft_res.device)
+            session_stream = _ort.get_provider_options().get('CUDAExecutionProvider', {}).get('user_compute_stream')
+            if session_stream != str(stream.cuda_stream):
+                stream.synchronize()
+        _ort.run_with_iobinding(io_binding, run_options)
         tar_waves = model.istft(ten)  # This operation is performed on the GPU
-        tar_waves = tar_waves.cpu()  # Move the result back to CPU only after all computations
-        tar_signal = tar_waves[:, :, trim:-trim].transpose(0, 1).reshape(2, -1).numpy()[:, :-pad]
+    return tar_waves[:, :, trim:-trim]
 
-        sources.append(tar_signal)
-    # print('Time demix base: {:.2f} sec'.format(time() - start_time))
-    return np.array(sources)
 
-
-def demix_full(mix, device, chunk_size, models, infer_session, overlap=0.75):
+def demix_full(mix, device, chunk_size, models, infer_session, overlap=0.75, io_binding=None, run_options=None):
     start_time = time()
 
+    model = models[0]
+    trim = model.n_fft // 2
+    gen_size = model.chunk_size - 2 * trim
+    n_sample = mix.shape[-1]
     step = int(chunk_size * (1 - overlap))
     # print('Initial shape: {} Chunk size: {} Step: {} Device: {}'.format(mix.shape, chunk_size, step, device))
-    result = np.zeros((1, 2, mix.shape[-1]), dtype=np.float32)
-    divider = np.zeros((1, 2, mix.shape[-1]), dtype=np.float32)
-
-    total = 0
-    for i in range(0, mix.shape[-1], step):
-        total += 1
-
-        start = i
-        end = min(i + chunk_size, mix.shape[-1])
-        # print('Chunk: {} Start: {} End: {}'.format(total, start, end))
-        mix_part = mix[:, start:end]
-        sources = demix_base(mix_part, device, models, infer_session)
-        # print(sources.shape)
-        result[..., start:end] += sources
-        divider[..., start:end] += 1
-    sources = result / divider
-    # print('Final shape: {} Overall time: {:.2f}'.format(sources.shape, time() - start_time))
-    return sources
+
+    # Split every overlapping chunk [start, end) into model windows upfront, so the model
+    # runs on large batches of windows instead of once per chunk
+    starts = np.arange(0, n_sample, step)
+    ends = np.minimum(starts + chunk_size, n_sample)
+    windows_per_chunk = (ends - starts + gen_size - 1) // gen_size
+    chunk_ids = np.repeat(np.arange(len(starts)), windows_per_chunk)
+    first_window = np.repeat(np.cumsum(windows_per_chunk) - windows_per_chunk, windows_per_chunk)
+    offsets = starts[chunk_ids] + (np.arange(len(chunk_ids)) - first_window) * gen_size
+    limits = ends[chunk_ids]
+    # Window samples outside of their own chunk are zeroed, as if the chunk was processed alone
+    lower = starts[chunk_ids] - offsets + trim
+    upper = limits - offsets + trim
+
+    mix_p = model.get_mix_buffer(trim + n_sample + model.chunk_size)
+    mix_p[:, :trim] = 0
+    mix_p[:, trim:trim + n_sample] = mix
+    mix_p[:, trim + n_sample:] = 0
+
+    # Accumulate on the model device, the result is copied back to host only once
+    result = torch.zeros((1, 2, n_sample), dtype=torch.float32, device=device)
+    # Number of chunks covering every sample, built from +1/-1 steps at chunk borders
+    coverage = np.zeros(n_sample + 1, dtype=np.float32)
+    np.add.at(coverage, starts, 1)
+    np.add.at(coverage, ends, -1)
+    coverage = torch.from_numpy(np.cumsum(coverage[:-1])).to(device)
+
+    # Every possible window is a strided view into mix_p, only the selected ones get copied
+    windows = torch.from_numpy(mix_p).unfold(1, model.chunk_size, 1).transpose(0, 1)
+    pin_memory = torch.device(device).type == 'cuda'
+
+    # Keep the same amount of windows per model call as a single chunk used to need
+    batch_size = model.get_input_shape(chunk_size)[0]
+    positions = np.arange(model.chunk_size)
+    for i in range(0, len(offsets), batch_size):
+        batch = slice(i, i + batch_size)
+        mix_waves = torch.empty((len(offsets[batch]), 2, model.chunk_size), dtype=torch.float32, pin_memory=pin_memory)
+        torch.index_select(windows, 0, torch.from_numpy(offsets[batch]), out=mix_waves)
+        mask = (positions >= lower[batch, None]) & (positions < upper[batch, None])
+        mix_waves *= torch.from_numpy(mask[:, None, :])
+        mix_waves = mix_waves.to(device, non_blocking=True)
+        # Run options (arena shrinkage) only matter once the last batch is done
+        last_batch = i + batch_size >= len(offsets)
+        tar_waves = demix_base(mix_waves, model, infer_session, io_binding, run_options if last_batch else None)
+        for offset, limit, tar in zip(offsets[batch], limits[batch], tar_waves):
+            length = min(gen_size, limit - offset)
+            result[0, :, offset:offset + length] += tar[:, :length]
+    result /= coverage
+    # print('Final shape: {} Overall time: {:.2f}'.format(result.shape, time() - start_time))
+    return result.cpu().numpy()
+
+
+def iterate_in_background(func, items):
+    # Yields (item, func(item)), func for the next item runs in a worker thread while the caller handles the current one
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(func, items[0]) if len(items) > 0 else None
+        for j, item in enumerate(items):
+            result = future.result()
+            if j + 1 < len(items):
+                future = executor.submit(func, items[j + 1])
+            yield item, result
+
+
+def blend_residual(residual, first, second, target, residual_weight, target_weight):
+    # (residual_weight * clip(residual - first - second) + target_weight * target) / 3 with one temporary
+    res = np.subtract(residual, first)
+    res -= second
+    np.clip(res, -1, 1, out=res)
+    res *= residual_weight / target_weight
+    res += target
+    res *= target_weight / 3.0
+    return res
+
+
+def mix_ensemble_stems(mixed_sound_array, vocals, out):
+    """
+        Combines averaged ensemble stems out (drums, bass, other, vocals), each stored as
+        (samples, channels), with the residual of the mixture without vocals. Returns other, drums, bass
+    """
+    residual = mixed_sound_array - vocals
+    other = blend_residual(residual, out[0], out[1], out[2], 2, 1)
+    drums = blend_residual(residual, out[1], out[2], out[0], 1, 2)
+    bass = blend_residual(residual, out[0], out[2], out[1], 1, 2)
+
+    # Every stem becomes the mixture without vocals minus the two other stems
+    residual -= other
+    residual -= drums
+    residual -= bass
+    other += residual
+    drums += residual
+    bass += residual
+    return other, drums, bass
 
 
 class EnsembleDemucsMDXMusicSeparationModel:
@@ -184,6 +398,26 @@ class EnsembleDemucsMDXMusicSeparationModel:
                 self.single_onnx = True
                 print('Use single vocal ONNX')
 
+        # CPU execution provider has no FP16 kernels
+        self.fp16_mdx = False
+        if 'fp16_mdx' in options:
+            if options['fp16_mdx'] and device != 'cpu':
+                self.fp16_mdx = True
+                print('Use FP16 ONNX models')
+
+        self.use_trt = False
+        if 'use_trt' in options:
+            if options['use_trt'] and device != 'cpu':
+                self.use_trt = True
+                print('Use TensorRT for ONNX models')
+
+        # htdemucs_6s is the heaviest model and has small weights in the ensemble
+        self.skip_6s = False
+        if 'skip_6s' in options:
+            if options['skip_6s']:
+                self.skip_6s = True
+                print('Skip htdemucs_6s model')
+
         self.kim_model_1 = False
         if 'use_kim_model_1' in options:
             if options['use_kim_model_1']:
@@ -224,14 +458,29 @@ class EnsembleDemucsMDXMusicSeparationModel:
         model2.to(device)
         self.models.append(model2)
 
-        model3 = pretrained.get_model('htdemucs_6s')
-        model3.to(device)
-        self.models.append(model3)
+        if not self.skip_6s:
+            model3 = pretrained.get_model('htdemucs_6s')
+            model3.to(device)
+            self.models.append(model3)
 
         model4 = pretrained.get_model('hdemucs_mmi')
         model4.to(device)
         self.models.append(model4)
 
+        if self.skip_6s:
+            self.weights_vocals = self.weights_vocals[[0, 1, 3]]
+            self.weights_bass = self.weights_bass[[0, 1, 3]]
+            self.weights_drums = self.weights_drums[[0, 1, 3]]
+            self.weights_other = self.weights_other[[0, 1, 3]]
+
+        # First call of every compiled model is slow, so it's only worth it for many files
+        if 'compile' in options:
+            if options['compile']:
+                print('Compile Demucs models')
+                compile_model(self.model_vocals_only)
+                for model in self.models:
+                    compile_model(model)
+
         if 0:
             for model in self.models:
                 print(model.sources)
@@ -248,20 +497,35 @@ class EnsembleDemucsMDXMusicSeparationModel:
         else:
             chunk_size = 1000000
             providers = ["CUDAExecutionProvider"]
+        # ONNX sessions must live on the same GPU as the torch tensors bound to them
+        device_id = torch.device(device).index or 0
         if 'chunk_size' in options:
             chunk_size = int(options['chunk_size'])
 
+        # Demucs and MDX models are independent, on separate streams their GPU work can overlap
+        self.stream_demucs = None
+        self.stream_mdx = None
+        if device != 'cpu':
+            self.stream_demucs = torch.cuda.Stream(device)
+            self.stream_mdx = torch.cuda.Stream(device)
+
         # MDX-B model 1 initialization
         self.chunk_size = chunk_size
         self.mdx_models1 = get_models('tdf_extra', load=False, device=device, vocals_model_type=2)
         model_path_onnx1 = model_folder + 'Kim_Vocal_2.onnx'
+        if self.fp16_mdx:
+            model_path_onnx1 = get_fp16_onnx_path(model_path_onnx1)
         print('Model path: {}'.format(model_path_onnx1))
         print('Device: {} Chunk size: {}'.format(device, chunk_size))
-        self.infer_session1 = ort.InferenceSession(
+        self.infer_session1 = get_infer_session(
             model_path_onnx1,
-            providers=providers,
-            provider_options=[{"device_id": 0}],
+            providers,
+            device_id,
+            use_trt=self.use_trt,
+            stream=self.stream_mdx,
+            input_shape=self.mdx_models1[0].get_input_shape(chunk_size),
         )
+        self.io_binding1 = self.infer_session1.io_binding()
 
         if self.single_onnx is False:
             # MDX-B model 2  initialization
@@ -269,13 +533,19 @@ class EnsembleDemucsMDXMusicSeparationModel:
             self.mdx_models2 = get_models('tdf_extra', load=False, device=device, vocals_model_type=2)
             root_path = os.path.dirname(os.path.realpath(__file__)) + '/'
             model_path_onnx2 = model_folder + 'Kim_Inst.onnx'
+            if self.fp16_mdx:
+                model_path_onnx2 = get_fp16_onnx_path(model_path_onnx2)
             print('Model path: {}'.format(model_path_onnx2))
             print('Device: {} Chunk size: {}'.format(device, chunk_size))
-            self.infer_session2 = ort.InferenceSession(
+            self.infer_session2 = get_infer_session(
                 model_path_onnx2,
-                providers=providers,
-                provider_options=[{"device_id": 0}],
+                providers,
+                device_id,
+                use_trt=self.use_trt,
+                stream=self.stream_mdx,
+                input_shape=self.mdx_models2[0].get_input_shape(chunk_size),
             )
+            self.io_binding2 = self.infer_session2.io_binding()
 
         self.device = device
         pass
@@ -289,6 +559,7 @@ class EnsembleDemucsMDXMusicSeparationModel:
         """ Will be used by the evaluator to provide logs, DO NOT CHANGE """
         raise NameError(msg)
     
+    @torch.inference_mode()
     def separate_music_file(
             self,
             mixed_sound_array,
@@ -315,7 +586,7 @@ class EnsembleDemucsMDXMusicSeparationModel:
         output_sample_rates = {}
 
         audio = np.expand_dims(mixed_sound_array.T, axis=0)
-        audio = torch.from_numpy(audio).type('torch.FloatTensor').to(self.device)
+        audio = to_device(audio, self.device)
 
         overlap_large = self.overlap_large
         overlap_small = self.overlap_small
@@ -324,47 +595,70 @@ class EnsembleDemucsMDXMusicSeparationModel:
         model = self.model_vocals_only
         shifts = 1
         overlap = overlap_large
-        vocals_demucs = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0][3].cpu().numpy()
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.10) / total_files
-            update_percent_func(int(val))
-
-        vocals_demucs += 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0][3].cpu().numpy()
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.20) / total_files
-            update_percent_func(int(val))
-
-        overlap = overlap_large
-        sources1 = demix_full(
-            mixed_sound_array.T,
-            self.device,
-            self.chunk_size,
-            self.mdx_models1,
-            self.infer_session1,
-            overlap=overlap
-        )[0]
-
-        vocals_mdxb1 = sources1
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.30) / total_files
-            update_percent_func(int(val))
+        def run_demucs_vocals():
+            # Worker thread doesn't inherit inference mode and current stream
+            with torch.inference_mode(), torch.cuda.stream(self.stream_demucs):
+                return apply_model_both_polarities(model, audio, shifts=shifts, overlap=overlap)[3]
+
+        # apply_model waits on host for its own results, so on GPU Demucs runs in a worker thread
+        # on its own stream while MDX models run in this one. On CPU both would compete for the same cores
+        demucs_executor = None
+        if self.stream_demucs is not None:
+            self.stream_demucs.wait_stream(torch.cuda.current_stream(self.device))
+            demucs_executor = ThreadPoolExecutor(max_workers=1)
+            vocals_demucs = demucs_executor.submit(run_demucs_vocals)
+        else:
+            vocals_demucs = run_demucs_vocals()
 
-        if self.single_onnx is False:
-            sources2 = -demix_full(
-                -mixed_sound_array.T,
-                self.device,
-                self.chunk_size,
-                self.mdx_models2,
-                self.infer_session2,
-                overlap=overlap
-            )[0]
+        # Demucs worker is joined even if MDX fails, so it doesn't keep running on GPU after the error
+        try:
+            if update_percent_func is not None:
+                val = 100 * (current_file_number + 0.20) / total_files
+                update_percent_func(int(val))
 
-            # it's instrumental so need to invert
-            instrum_mdxb2 = sources2
-            vocals_mdxb2 = mixed_sound_array.T - instrum_mdxb2
+            overlap = overlap_large
+            with torch.cuda.stream(self.stream_mdx):
+                sources1 = demix_full(
+                    mixed_sound_array.T,
+                    self.device,
+                    self.chunk_size,
+                    self.mdx_models1,
+                    self.infer_session1,
+                    overlap=overlap,
+                    io_binding=self.io_binding1,
+                )[0]
+
+            vocals_mdxb1 = np.ascontiguousarray(sources1.T)
+
+            if update_percent_func is not None:
+                val = 100 * (current_file_number + 0.30) / total_files
+                update_percent_func(int(val))
+
+            if self.single_onnx is False:
+                with torch.cuda.stream(self.stream_mdx):
+                    sources2 = -demix_full(
+                        -mixed_sound_array.T,
+                        self.device,
+                        self.chunk_size,
+                        self.mdx_models2,
+                        self.infer_session2,
+                        overlap=overlap,
+                        io_binding=self.io_binding2,
+                    )[0]
+
+                # it's instrumental so need to invert
+                instrum_mdxb2 = np.ascontiguousarray(sources2.T)
+                vocals_mdxb2 = mixed_sound_array - instrum_mdxb2
+
+            if demucs_executor is not None:
+                vocals_demucs = vocals_demucs.result()
+        finally:
+            if demucs_executor is not None:
+                demucs_executor.shutdown()
+        if demucs_executor is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream_demucs)
+        vocals_demucs = np.ascontiguousarray(vocals_demucs.cpu().numpy().T)
 
         if update_percent_func is not None:
             val = 100 * (current_file_number + 0.40) / total_files
@@ -373,10 +667,10 @@ class EnsembleDemucsMDXMusicSeparationModel:
         # Ensemble vocals for MDX and Demucs
         if self.single_onnx is False:
             weights = np.array([12, 8, 3])
-            vocals = (weights[0] * vocals_mdxb1.T + weights[1] * vocals_mdxb2.T + weights[2] * vocals_demucs.T) / weights.sum()
+            vocals = (weights[0] * vocals_mdxb1 + weights[1] * vocals_mdxb2 + weights[2] * vocals_demucs) / weights.sum()
         else:
             weights = np.array([6, 1])
-            vocals = (weights[0] * vocals_mdxb1.T + weights[1] * vocals_demucs.T) / weights.sum()
+            vocals = (weights[0] * vocals_mdxb1 + weights[1] * vocals_demucs) / weights.sum()
 
         # vocals
         separated_music_arrays['vocals'] = vocals
@@ -387,22 +681,26 @@ class EnsembleDemucsMDXMusicSeparationModel:
             instrum = mixed_sound_array - vocals
 
             audio = np.expand_dims(instrum.T, axis=0)
-            audio = torch.from_numpy(audio).type('torch.FloatTensor').to(self.device)
-
+            audio = to_device(audio, self.device)
+
+            def run_model(i):
+                # Worker thread doesn't inherit inference mode
+                with torch.inference_mode():
+                    if i == 0:
+                        overlap = overlap_small
+                    else:
+                        overlap = overlap_large
+                    model = self.models[i]
+                    return apply_model_both_polarities(model, audio, shifts=shifts, overlap=overlap).cpu().numpy()
+
+            # Next model runs on GPU while weights are applied to the previous output
             all_outs = []
-            for i, model in enumerate(self.models):
-                if i == 0:
-                    overlap = overlap_small
-                elif i > 0:
-                    overlap = overlap_large
-                out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-                      + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-
+            for i, out in iterate_in_background(run_model, list(range(len(self.models)))):
                 if update_percent_func is not None:
                     val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
                     update_percent_func(int(val))
 
-                if i == 2:
+                if len(out) == 6:
                     # ['drums', 'bass', 'other', 'vocals', 'guitar', 'piano']
                     out[2] = out[2] + out[4] + out[5]
                     out = out[:4]
@@ -418,33 +716,17 @@ class EnsembleDemucsMDXMusicSeparationModel:
             out[1] = out[1] / self.weights_bass.sum()
             out[2] = out[2] / self.weights_other.sum()
             out[3] = out[3] / self.weights_vocals.sum()
+            out = np.ascontiguousarray(out.transpose(0, 2, 1))
 
-            # other
-            res = mixed_sound_array - vocals - out[0].T - out[1].T
-            res = np.clip(res, -1, 1)
-            separated_music_arrays['other'] = (2 * res + out[2].T) / 3.0
+            # other, drums, bass
+            other, drums, bass = mix_ensemble_stems(mixed_sound_array, vocals, out)
+            separated_music_arrays['other'] = other
             output_sample_rates['other'] = sample_rate
-
-            # drums
-            res = mixed_sound_array - vocals - out[1].T - out[2].T
-            res = np.clip(res, -1, 1)
-            separated_music_arrays['drums'] = (res + 2 * out[0].T.copy()) / 3.0
+            separated_music_arrays['drums'] = drums
             output_sample_rates['drums'] = sample_rate
-
-            # bass
-            res = mixed_sound_array - vocals - out[0].T - out[2].T
-            res = np.clip(res, -1, 1)
-            separated_music_arrays['bass'] = (res + 2 * out[1].T) / 3.0
+            separated_music_arrays['bass'] = bass
             output_sample_rates['bass'] = sample_rate
 
-            bass = separated_music_arrays['bass']
-            drums = separated_music_arrays['drums']
-            other = separated_music_arrays['other']
-
-            separated_music_arrays['other'] = mixed_sound_array - vocals - bass - drums
-            separated_music_arrays['drums'] = mixed_sound_array - vocals - bass - other
-            separated_music_arrays['bass'] = mixed_sound_array - vocals - drums - other
-
         if update_percent_func is not None:
             val = 100 * (current_file_number + 0.95) / total_files
             update_percent_func(int(val))
@@ -476,6 +758,26 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
                 self.single_onnx = True
                 print('Use single vocal ONNX')
 
+        # CPU execution provider has no FP16 kernels
+        self.fp16_mdx = False
+        if 'fp16_mdx' in options:
+            if options['fp16_mdx'] and device != 'cpu':
+                self.fp16_mdx = True
+                print('Use FP16 ONNX models')
+
+        self.use_trt = False
+        if 'use_trt' in options:
+            if options['use_trt'] and device != 'cpu':
+                self.use_trt = True
+                print('Use TensorRT for ONNX models')
+
+        # htdemucs_6s is the heaviest model and has small weights in the ensemble
+        self.skip_6s = False
+        if 'skip_6s' in options:
+            if options['skip_6s']:
+                self.skip_6s = True
+                print('Skip htdemucs_6s model')
+
         self.kim_model_1 = False
         if 'use_kim_model_1' in options:
             if options['use_kim_model_1']:
@@ -500,6 +802,13 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         self.weights_bass = np.array([19, 4, 5, 8])
         self.weights_drums = np.array([18, 2, 4, 9])
         self.weights_other = np.array([14, 2, 5, 10])
+        self.model_names = ['htdemucs_ft', 'htdemucs', 'htdemucs_6s', 'hdemucs_mmi']
+        if self.skip_6s:
+            self.model_names = ['htdemucs_ft', 'htdemucs', 'hdemucs_mmi']
+            self.weights_vocals = self.weights_vocals[[0, 1, 3]]
+            self.weights_bass = self.weights_bass[[0, 1, 3]]
+            self.weights_drums = self.weights_drums[[0, 1, 3]]
+            self.weights_other = self.weights_other[[0, 1, 3]]
 
         if device == 'cpu':
             chunk_size = 200000000
@@ -511,6 +820,32 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
             chunk_size = int(options['chunk_size'])
         self.chunk_size = chunk_size
         self.device = device
+        self.device_id = torch.device(device).index or 0
+        self.run_options = None
+        if device != 'cpu':
+            self.run_options = get_low_memory_run_options(self.device_id)
+
+        # ONNX sessions are created once, building them again for every file is slow
+        mdx_input_shape = None
+        if self.use_trt:
+            mdx_input_shape = get_models('tdf_extra', load=False, device='cpu', vocals_model_type=2)[0].get_input_shape(self.chunk_size)
+        model_folder = os.path.dirname(os.path.realpath(__file__)) + '/models/'
+        model_path_onnx1 = model_folder + 'Kim_Vocal_2.onnx'
+        if self.fp16_mdx:
+            model_path_onnx1 = get_fp16_onnx_path(model_path_onnx1)
+        print('Model path: {}'.format(model_path_onnx1))
+        print('Device: {} Chunk size: {}'.format(self.device, self.chunk_size))
+        self.infer_session1 = get_infer_session(model_path_onnx1, self.providers, self.device_id, low_memory=True, use_trt=self.use_trt, input_shape=mdx_input_shape)
+        self.io_binding1 = self.infer_session1.io_binding()
+
+        if self.single_onnx is False:
+            model_path_onnx2 = model_folder + 'Kim_Inst.onnx'
+            if self.fp16_mdx:
+                model_path_onnx2 = get_fp16_onnx_path(model_path_onnx2)
+            print('Model path: {}'.format(model_path_onnx2))
+            print('Device: {} Chunk size: {}'.format(self.device, self.chunk_size))
+            self.infer_session2 = get_infer_session(model_path_onnx2, self.providers, self.device_id, low_memory=True, use_trt=self.use_trt, input_shape=mdx_input_shape)
+            self.io_binding2 = self.infer_session2.io_binding()
         pass
 
     @property
@@ -522,6 +857,7 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         """ Will be used by the evaluator to provide logs, DO NOT CHANGE """
         raise NameError(msg)
 
+    @torch.inference_mode()
     def separate_music_file(
             self,
             mixed_sound_array,
@@ -548,7 +884,7 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         output_sample_rates = {}
 
         audio = np.expand_dims(mixed_sound_array.T, axis=0)
-        audio = torch.from_numpy(audio).type('torch.FloatTensor').to(self.device)
+        audio = to_device(audio, self.device)
 
         overlap_large = self.overlap_large
         overlap_small = self.overlap_small
@@ -556,17 +892,12 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         # Get Demucs vocal only
         model_folder = os.path.dirname(os.path.realpath(__file__)) + '/models/'
         model_path = model_folder + '04573f0d-f3cf25b2.th'
-        model_vocals = load_model(model_path)
+        model_vocals = get_demucs_model(model_path)
         model_vocals.to(self.device)
         shifts = 1
         overlap = overlap_large
-        vocals_demucs = 0.5 * apply_model(model_vocals, audio, shifts=shifts, overlap=overlap)[0][3].cpu().numpy()
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.10) / total_files
-            update_percent_func(int(val))
-
-        vocals_demucs += 0.5 * -apply_model(model_vocals, -audio, shifts=shifts, overlap=overlap)[0][3].cpu().numpy()
+        vocals_demucs = apply_model_both_polarities(model_vocals, audio, shifts=shifts, overlap=overlap, batched=False)[3].cpu().numpy()
+        vocals_demucs = np.ascontiguousarray(vocals_demucs.T)
         model_vocals = model_vocals.cpu()
         del model_vocals
 
@@ -574,27 +905,20 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
             val = 100 * (current_file_number + 0.20) / total_files
             update_percent_func(int(val))
 
-        # MDX-B model 1 initialization
+        # MDX-B model 1
         mdx_models1 = get_models('tdf_extra', load=False, device=self.device, vocals_model_type=2)
-        model_path_onnx1 = model_folder + 'Kim_Vocal_2.onnx'
-        print('Model path: {}'.format(model_path_onnx1))
-        print('Device: {} Chunk size: {}'.format(self.device, self.chunk_size))
-        infer_session1 = ort.InferenceSession(
-            model_path_onnx1,
-            providers=self.providers,
-            provider_options=[{"device_id": 0}],
-        )
         overlap = overlap_large
         sources1 = demix_full(
             mixed_sound_array.T,
             self.device,
             self.chunk_size,
             mdx_models1,
-            infer_session1,
-            overlap=overlap
+            self.infer_session1,
+            overlap=overlap,
+            io_binding=self.io_binding1,
+            run_options=self.run_options,
         )[0]
-        vocals_mdxb1 = sources1
-        del infer_session1
+        vocals_mdxb1 = np.ascontiguousarray(sources1.T)
         del mdx_models1
 
         if update_percent_func is not None:
@@ -602,32 +926,23 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
             update_percent_func(int(val))
 
         if self.single_onnx is False:
-            # MDX-B model 2  initialization
+            # MDX-B model 2
             mdx_models2 = get_models('tdf_extra', load=False, device=self.device, vocals_model_type=2)
-            root_path = os.path.dirname(os.path.realpath(__file__)) + '/'
-            model_path_onnx2 = model_folder + 'Kim_Inst.onnx'
-            print('Model path: {}'.format(model_path_onnx2))
-            print('Device: {} Chunk size: {}'.format(self.device, self.chunk_size))
-            infer_session2 = ort.InferenceSession(
-                model_path_onnx2,
-                providers=self.providers,
-                provider_options=[{"device_id": 0}],
-            )
-
             overlap = overlap_large
             sources2 = -demix_full(
                 -mixed_sound_array.T,
                 self.device,
                 self.chunk_size,
                 mdx_models2,
-                infer_session2,
-                overlap=overlap
+                self.infer_session2,
+                overlap=overlap,
+                io_binding=self.io_binding2,
+                run_options=self.run_options,
             )[0]
 
             # it's instrumental so need to invert
-            instrum_mdxb2 = sources2
-            vocals_mdxb2 = mixed_sound_array.T - instrum_mdxb2
-            del infer_session2
+            instrum_mdxb2 = np.ascontiguousarray(sources2.T)
+            vocals_mdxb2 = mixed_sound_array - instrum_mdxb2
             del mdx_models2
 
         if update_percent_func is not None:
@@ -637,133 +952,69 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         # Ensemble vocals for MDX and Demucs
         if self.single_onnx is False:
             weights = np.array([12, 8, 3])
-            vocals = (weights[0] * vocals_mdxb1.T + weights[1] * vocals_mdxb2.T + weights[2] * vocals_demucs.T) / weights.sum()
+            vocals = (weights[0] * vocals_mdxb1 + weights[1] * vocals_mdxb2 + weights[2] * vocals_demucs) / weights.sum()
         else:
             weights = np.array([6, 1])
-            vocals = (weights[0] * vocals_mdxb1.T + weights[1] * vocals_demucs.T) / weights.sum()
+            vocals = (weights[0] * vocals_mdxb1 + weights[1] * vocals_demucs) / weights.sum()
 
         # Generate instrumental
         instrum = mixed_sound_array - vocals
 
         audio = np.expand_dims(instrum.T, axis=0)
-        audio = torch.from_numpy(audio).type('torch.FloatTensor').to(self.device)
+        audio = to_device(audio, self.device)
 
+        def run_model(i):
+            # Worker thread doesn't inherit inference mode
+            with torch.inference_mode():
+                if i == 0:
+                    overlap = overlap_small
+                else:
+                    overlap = overlap_large
+                model = get_demucs_model(self.model_names[i])
+                model.to(self.device)
+                out = apply_model_both_polarities(model, audio, shifts=shifts, overlap=overlap, batched=False).cpu().numpy()
+                model = model.cpu()
+                del model
+                return out
+
+        # Next model is only submitted after the previous one went back to CPU,
+        # so a single model is on GPU while weights are applied to the previous output
         all_outs = []
-
-        i = 0
-        overlap = overlap_small
-        model = pretrained.get_model('htdemucs_ft')
-        model.to(self.device)
-        out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-              + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
-
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
-
-        i = 1
-        overlap = overlap_large
-        model = pretrained.get_model('htdemucs')
-        model.to(self.device)
-        out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-              + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
-
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
-
-        i = 2
-        overlap = overlap_large
-        model = pretrained.get_model('htdemucs_6s')
-        model.to(self.device)
-        out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-              + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
-
-        # More stems need to add
-        out[2] = out[2] + out[4] + out[5]
-        out = out[:4]
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
-
-        i = 3
-        model = pretrained.get_model('hdemucs_mmi')
-        model.to(self.device)
-        out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-              + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
-
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
+        for i, out in iterate_in_background(run_model, list(range(len(self.model_names)))):
+            if update_percent_func is not None:
+                val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
+                update_percent_func(int(val))
+
+            if len(out) == 6:
+                # More stems need to add
+                out[2] = out[2] + out[4] + out[5]
+                out = out[:4]
+            out[0] = self.weights_drums[i] * out[0]
+            out[1] = self.weights_bass[i] * out[1]
+            out[2] = self.weights_other[i] * out[2]
+            out[3] = self.weights_vocals[i] * out[3]
+            all_outs.append(out)
 
         out = np.array(all_outs).sum(axis=0)
         out[0] = out[0] / self.weights_drums.sum()
         out[1] = out[1] / self.weights_bass.sum()
         out[2] = out[2] / self.weights_other.sum()
         out[3] = out[3] / self.weights_vocals.sum()
+        out = np.ascontiguousarray(out.transpose(0, 2, 1))
 
         # vocals
         separated_music_arrays['vocals'] = vocals
         output_sample_rates['vocals'] = sample_rate
 
-        # other
-        res = mixed_sound_array - vocals - out[0].T - out[1].T
-        res = np.clip(res, -1, 1)
-        separated_music_arrays['other'] = (2 * res + out[2].T) / 3.0
+        # other, drums, bass
+        other, drums, bass = mix_ensemble_stems(mixed_sound_array, vocals, out)
+        separated_music_arrays['other'] = other
         output_sample_rates['other'] = sample_rate
-
-        # drums
-        res = mixed_sound_array - vocals - out[1].T - out[2].T
-        res = np.clip(res, -1, 1)
-        separated_music_arrays['drums'] = (res + 2 * out[0].T.copy()) / 3.0
+        separated_music_arrays['drums'] = drums
         output_sample_rates['drums'] = sample_rate
-
-        # bass
-        res = mixed_sound_array - vocals - out[0].T - out[2].T
-        res = np.clip(res, -1, 1)
-        separated_music_arrays['bass'] = (res + 2 * out[1].T) / 3.0
+        separated_music_arrays['bass'] = bass
         output_sample_rates['bass'] = sample_rate
 
-        bass = separated_music_arrays['bass']
-        drums = separated_music_arrays['drums']
-        other = separated_music_arrays['other']
-
-        separated_music_arrays['other'] = mixed_sound_array - vocals - bass - drums
-        separated_music_arrays['drums'] = mixed_sound_array - vocals - bass - other
-        separated_music_arrays['bass'] = mixed_sound_array - vocals - drums - other
-
         if update_percent_func is not None:
             val = 100 * (current_file_number + 0.95) / total_files
             update_percent_func(int(val))
@@ -771,6 +1022,63 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         return separated_music_arrays, output_sample_rates
 
 
+def get_wav_header(length, channels, sample_rate, format_tag, sample_width):
+    # 44 byte WAV header, format tag 1 is integer PCM and 3 is IEEE float
+    data_size = length * channels * sample_width
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, format_tag, channels, sample_rate, sample_rate * channels * sample_width, channels * sample_width, 8 * sample_width,
+        b'data', data_size,
+    )
+
+
+def write_audio(path, data, sample_rate, output_subtype='FLOAT'):
+    if output_subtype == 'FLAC':
+        with sf.SoundFile(path, mode='w', samplerate=sample_rate, channels=data.shape[1], subtype='PCM_16', format='FLAC') as out:
+            out.write(data)
+        return path
+
+    if output_subtype == 'PCM_16':
+        # Same scale as libsndfile, but clipped instead of wrapped around
+        data = np.clip(np.rint(data * 32767.0), -32768, 32767).astype('<i2')
+        header = get_wav_header(data.shape[0], data.shape[1], sample_rate, 1, 2)
+    else:
+        data = np.ascontiguousarray(data, dtype='<f4')
+        header = get_wav_header(data.shape[0], data.shape[1], sample_rate, 3, 4)
+
+    # Size of output is known, so header is final from the start
+    file_size = len(header) + data.nbytes
+    with open(path, 'wb+') as f:
+        if hasattr(os, 'posix_fallocate'):
+            # Space is reserved before mapping, so a full disk is a clean ENOSPC instead of SIGBUS on page fault.
+            # Samples are copied straight into the page cache, writeback is left to the kernel
+            os.posix_fallocate(f.fileno(), 0, file_size)
+            with mmap.mmap(f.fileno(), file_size) as mm:
+                mm[:len(header)] = header
+                samples = np.frombuffer(mm, dtype=data.dtype, offset=len(header)).reshape(data.shape)
+                samples[:] = data
+                # Mapping can't be closed while array still points to it
+                del samples
+        else:
+            f.write(header)
+            f.write(memoryview(data))
+    return path
+
+
+def throttle_percent_func(update_percent_func):
+    # Callback may go to GUI thread, so it's only called when percent value changes
+    last_percent = [-1]
+
+    def throttled(val):
+        percent = int(val)
+        if percent != last_percent[0]:
+            last_percent[0] = percent
+            update_percent_func(percent)
+
+    return throttled
+
+
 def predict_with_model(options):
     for input_audio in options['input_audio']:
         if not os.path.isfile(input_audio):
@@ -780,12 +1088,35 @@ def predict_with_model(options):
     if not os.path.isdir(output_folder):
         os.mkdir(output_folder)
 
+    # Copies of all output files are also placed in these folders
+    mirror_folders = []
+    if 'mirror_folders' in options:
+        if options['mirror_folders'] is not None:
+            mirror_folders = options['mirror_folders']
+    for folder in mirror_folders:
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        if os.path.samefile(folder, output_folder):
+            print('Error. Mirror folder is the same as output folder: {}'.format(folder))
+            return
+
+    output_subtype = 'FLOAT'
+    if 'output_subtype' in options:
+        output_subtype = options['output_subtype']
+    output_ext = 'flac' if output_subtype == 'FLAC' else 'wav'
+
     only_vocals = False
     if 'only_vocals' in options:
         if options['only_vocals'] is True:
             print('Generate only vocals and instrumental')
             only_vocals = True
 
+    fast_instrum = False
+    if 'fast_instrum' in options:
+        if options['fast_instrum'] is True:
+            print('Use sum of bass, drums and other as instrumental')
+            fast_instrum = True
+
     model = None
     if 'large_gpu' in options:
         if options['large_gpu'] is True:
@@ -798,17 +1129,71 @@ def predict_with_model(options):
     update_percent_func = None
     if 'update_percent_func' in options:
         update_percent_func = options['update_percent_func']
+    separation_percent_func = None
+    if update_percent_func is not None:
+        separation_percent_func = throttle_percent_func(update_percent_func)
+
+    # Stems of previous file are written in background while next file is separated
+    writer = ThreadPoolExecutor(max_workers=min(6, os.cpu_count() or 1))
+    pending_writes = []
+
+    # Instrumental buffers are reused between files, they only grow for longer tracks
+    output_buffers = {}
+
+    def get_output_buffer(name, shape):
+        buffer = output_buffers.get(name)
+        if buffer is None or buffer.shape[0] < shape[0] or buffer.shape[1:] != shape[1:]:
+            buffer = np.empty(shape, dtype=np.float32)
+            output_buffers[name] = buffer
+        return buffer[:shape[0]]
+
+    def write_stem(path, data, sample_rate):
+        write_audio(path, data, sample_rate, output_subtype)
+        for folder in mirror_folders:
+            # Copied inside the kernel (sendfile on Linux), works across filesystems
+            shutil.copyfile(path, os.path.join(folder, os.path.basename(path)))
+        # Output isn't read back after mirror copies, on Linux it starts writeback and keeps it out of page cache
+        if hasattr(os, 'posix_fadvise'):
+            with open(path, 'rb') as f:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        return path
+
+    def wait_for_writes(futures):
+        # Messages for all stems of a file are printed at once, not from the writer threads
+        created = [future.result() for future in futures]
+        if len(created) > 0:
+            print('\n'.join('File created: {}'.format(path) for path in created), flush=True)
 
     for i, input_audio in enumerate(options['input_audio']):
         print('Go for: {}'.format(input_audio))
-        audio, sr = librosa.load(input_audio, mono=False, sr=44100)
-        if len(audio.shape) == 1:
-            audio = np.stack([audio, audio], axis=0)
+        try:
+            data, sr = sf.read(input_audio, dtype='float32', always_2d=True)
+            audio = data.T
+        except RuntimeError:
+            # sf.LibsndfileError (soundfile 0.11+) is a RuntimeError, older versions raise RuntimeError directly
+            # Formats libsndfile can't decode (m4a, aac, mp3 with old libsndfile) are loaded with librosa
+            import librosa
+            audio, sr = librosa.load(input_audio, mono=False, sr=44100)
+            if len(audio.shape) == 1:
+                audio = np.expand_dims(audio, axis=0)
+        if audio.shape[0] == 1:
+            audio = np.concatenate([audio, audio], axis=0)
+        if sr != 44100:
+            # Resample on the same device as the models
+            audio = torchaudio.functional.resample(
+                to_device(np.ascontiguousarray(audio), model.device),
+                sr,
+                44100,
+                resampling_method='sinc_interp_kaiser',
+            ).cpu().numpy()
+            sr = 44100
         print("Input audio: {} Sample rate: {}".format(audio.shape, sr))
+        # Same (samples, channels) layout as separated stems. No copy if audio wasn't resampled
+        mixed_sound_array = np.ascontiguousarray(audio.T)
         result, sample_rates = model.separate_music_file(
-            audio.T,
+            mixed_sound_array,
             sr,
-            update_percent_func,
+            separation_percent_func,
             i,
             len(options['input_audio']),
             only_vocals,
@@ -816,23 +1201,38 @@ def predict_with_model(options):
         all_instrum = model.instruments
         if only_vocals:
             all_instrum = ['vocals']
+        output_prefix = os.path.join(output_folder, os.path.splitext(os.path.basename(input_audio))[0])
+        jobs = []
         for instrum in all_instrum:
-            output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_{}.wav'.format(instrum)
-            sf.write(output_folder + '/' + output_name, result[instrum], sample_rates[instrum], subtype='FLOAT')
-            print('File created: {}'.format(output_folder + '/' + output_name))
+            jobs.append(('{}_{}.{}'.format(output_prefix, instrum, output_ext), result[instrum], sample_rates[instrum]))
 
-        # instrumental part 1
-        inst = audio.T - result['vocals']
-        output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_{}.wav'.format('instrum')
-        sf.write(output_folder + '/' + output_name, inst, sr, subtype='FLOAT')
-        print('File created: {}'.format(output_folder + '/' + output_name))
+        # Buffers of previous file must be on disk before they are reused.
+        # Only one file is kept in memory waiting for disk
+        wait_for_writes(pending_writes)
 
         if not only_vocals:
             # instrumental part 2
-            inst2 = result['bass'] + result['drums'] + result['other']
-            output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_{}.wav'.format('instrum2')
-            sf.write(output_folder + '/' + output_name, inst2, sr, subtype='FLOAT')
-            print('File created: {}'.format(output_folder + '/' + output_name))
+            # Sum is accumulated in place, without temporary for bass + drums
+            inst2 = get_output_buffer('instrum2', result['bass'].shape)
+            np.add(result['bass'], result['drums'], out=inst2)
+            np.add(inst2, result['other'], out=inst2)
+
+        # instrumental part 1
+        if not only_vocals and fast_instrum:
+            # Mixture minus vocals is almost the same as sum of other stems
+            inst = inst2
+        else:
+            inst = get_output_buffer('instrum', result['vocals'].shape)
+            np.subtract(mixed_sound_array, result['vocals'], out=inst)
+        jobs.append(('{}_{}.{}'.format(output_prefix, 'instrum', output_ext), inst, sr))
+
+        if not only_vocals:
+            jobs.append(('{}_{}.{}'.format(output_prefix, 'instrum2', output_ext), inst2, sr))
+
+        pending_writes = [writer.submit(write_stem, *job) for job in jobs]
+
+    wait_for_writes(pending_writes)
+    writer.shutdown()
 
     if update_percent_func is not None:
         val = 100
@@ -841,9 +1241,18 @@ def predict_with_model(options):
 
 def md5(fname):
     hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
+    with open(fname, "rb", buffering=0) as f:
+        # Python 3.11+ does the whole read and update loop in C
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'md5').hexdigest()
+        # Empty file can't be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return hash_md5.hexdigest()
+        # Whole file is hashed in a single call, hashlib releases the GIL while it works
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            hash_md5.update(mm)
     return hash_md5.hexdigest()
 
 
@@ -860,20 +1269,17 @@ if __name__ == '__main__':
     m.add_argument("--single_onnx", action='store_true', help="Only use single ONNX model for vocals. Can be useful if you have not enough GPU memory.")
     m.add_argument("--chunk_size", "-cz", type=int, help="Chunk size for ONNX models. Set lower to reduce GPU memory consumption. Default: 1000000", required=False, default=1000000)
     m.add_argument("--large_gpu", action='store_true', help="It will store all models on GPU for faster processing of multiple audio files. Requires 11 and more GB of free GPU memory.")
+    m.add_argument("--compile", action='store_true', help="Compile Demucs models with torch.compile. Works only with --large_gpu. First file is much slower, next ones are faster.")
+    m.add_argument("--fp16_mdx", action='store_true', help="Run MDX ONNX models in FP16 on GPU. Models are converted on first use (requires onnx and onnxconverter-common).")
+    m.add_argument("--use_trt", action='store_true', help="Run MDX ONNX models with TensorRT on GPU. First run builds and caches engines in models/trt_cache/, it can take several minutes.")
+    m.add_argument("--skip_6s", action='store_true', help="Skip htdemucs_6s model in bass, drums, other ensemble. Faster, but a bit lower quality.")
     m.add_argument("--use_kim_model_1", action='store_true', help="Use first version of Kim model (as it was on contest).")
     m.add_argument("--only_vocals", action='store_true', help="Only create vocals and instrumental. Skip bass, drums, other")
+    m.add_argument("--fast_instrum", action='store_true', help="Save sum of bass, drums and other as instrumental instead of mixture minus vocals. Ignored with --only_vocals.")
+    m.add_argument("--output_subtype", type=str, choices=['FLOAT', 'PCM_16', 'FLAC'], help="Format of output files: 32-bit float WAV, 16-bit WAV or 16-bit FLAC (default: FLOAT)", required=False, default='FLOAT')
+    m.add_argument("--mirror_folders", nargs='+', type=str, help="Additional folders to put copies of all output files to", required=False, default=None)
     m.add_argument("--gpu_id", "-g", type=int, help="Specify which GPU to use (default: 0)", required=False, default=0)
 
-    gpu_use = "0"
-    if '--gpu_id' in sys.argv:
-        idx = sys.argv.index('--gpu_id')
-        if idx + 1 < len(sys.argv):
-            gpu_use = sys.argv[idx + 1]
-    elif '-g' in sys.argv:
-        idx = sys.argv.index('-g')
-        if idx + 1 < len(sys.argv):
-            gpu_use = sys.argv[idx + 1]
-    
     options = m.parse_args().__dict__
     print("Options: ".format(options))
     for el in options: